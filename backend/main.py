@@ -14,19 +14,32 @@
 - Автодокументация: /docs (Swagger UI)
 """
 
+import asyncio
+import logging
 import os
-from datetime import datetime
-from typing import List, Optional, Literal
+import re
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import AsyncIterator, List, Optional, Literal
 
-from fastapi import FastAPI, HTTPException, Query
+import orjson
+from cachetools import TTLCache
+
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from bson import ObjectId
+from bson.regex import Regex
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения из .env при наличии
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # ---------------------------------------------------------
 # ВСПОМОГАТЕЛЬНЫЕ КЛАССЫ ДЛЯ ObjectId
 # ---------------------------------------------------------
@@ -102,7 +115,8 @@ class SalesByProductRow(BaseModel):
 # ---------------------------------------------------------
 # ИНИЦИАЛИЗАЦИЯ ПРИЛОЖЕНИЯ И БАЗЫ ДАННЫХ
 # ---------------------------------------------------------
-app = FastAPI(title="Shop Back-office API", version="1.0.0")
+# ORJSONResponse: сериализация ответов в C (orjson) вместо стандартного json
+app = FastAPI(title="Shop Back-office API", version="1.0.0", default_response_class=ORJSONResponse)
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -115,77 +129,249 @@ app.add_middleware(
 )
 
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017/shopdb")
-client = AsyncIOMotorClient(MONGODB_URI)
+# minPoolSize держит прогретые соединения, чтобы первый запрос не ждал TCP-handshake
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+client = AsyncIOMotorClient(MONGODB_URI, minPoolSize=MONGO_MIN_POOL_SIZE, maxPoolSize=MONGO_MAX_POOL_SIZE)
 db = client.get_default_database()  # берём БД из URI (последний сегмент)
 
 products_col = db["products"]
 customers_col = db["customers"]
 orders_col = db["orders"]
+# Материализованные счётчики продаж: {_id: product_id, product_name, total_sold_qty}
+product_sales_col = db["product_sales"]
+# Отметки о разовых фоновых миграциях: {_id: имя миграции, started_at}
+migrations_col = db["migrations"]
+
+# Кэш sku/названий товаров в памяти процесса: каталог меняется редко, а читается часто.
+# Кэш у каждого воркера uvicorn свой и не инвалидируется между ними — устаревание
+# ограничено TTL. Остатки в нём не хранятся, поэтому списания его не затрагивают
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "4096"))
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", "60"))
+product_cache = TTLCache(maxsize=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL)
+
+
+async def get_products(pids) -> dict:
+    """Товары по ID: сначала из кэша, промахи — одним запросом $in."""
+    found = {}
+    misses = []
+    for pid in pids:
+        prod = product_cache.get(pid)
+        if prod is None:
+            misses.append(pid)
+        else:
+            found[pid] = prod
+    if misses:
+        async for prod in products_col.find({"_id": {"$in": misses}}, {"sku": 1, "name": 1}):
+            product_cache[prod["_id"]] = prod
+            found[prod["_id"]] = prod
+    return found
+
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+startup_tasks = set()
+
+
+async def run_once(name: str, job) -> None:
+    """Выполняем разовую миграцию: её берёт тот процесс, который первым записал отметку.
+
+    Остальные воркеры и последующие запуски видят отметку и ничего не делают.
+    При ошибке отметка снимается, и миграция повторится при следующем старте.
+    """
+    try:
+        await migrations_col.insert_one({"_id": name, "started_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        return
+    try:
+        await job()
+    except Exception:
+        logger.exception("Миграция %s не выполнена", name)
+        await migrations_col.delete_one({"_id": name})
 
-# Создадим полезные индексы (асинхронно при первом запросе)
+
+def start_once(name: str, job) -> None:
+    """Запускаем run_once в фоне, не задерживая старт приложения."""
+    task = asyncio.create_task(run_once(name, job))
+    startup_tasks.add(task)
+    task.add_done_callback(startup_tasks.discard)
+
+
+# Создадим полезные индексы при старте приложения
 @app.on_event("startup")
 async def on_startup():
-    # Индексы: уникальность артикулов, поиск клиентов, ускорение по заказам
-    await products_col.create_index("sku", unique=True)
-    await customers_col.create_index("email", unique=True)
-    await customers_col.create_index("full_name")
-    await orders_col.create_index("status")
-    await orders_col.create_index("customer_id")
-    await orders_col.create_index("date")
+    # Прогреваем пул соединений
+    await client.admin.command("ping")
+    # Индексы: уникальность артикулов, поиск клиентов, ускорение по заказам.
+    # create_index идемпотентен, поэтому запускаем все вызовы параллельно
+    await asyncio.gather(
+        products_col.create_index("sku", unique=True),
+        customers_col.create_index("email", unique=True),
+        customers_col.create_index([("full_name", "text")], default_language="russian"),
+        # ФИО в нижнем регистре: префиксный regex без флага i ограничивает скан этим индексом
+        customers_col.create_index("full_name_lower"),
+        # Составные индексы под фильтр + сортировку по дате (правило Equality-Sort-Range)
+        orders_col.create_index([("status", 1), ("date", -1)]),
+        orders_col.create_index([("customer_id", 1), ("date", -1)]),
+        orders_col.create_index([("date", -1)]),
+        # Multikey-индекс: поиск заказов, содержащих товар, и пересчёт продаж по товарам
+        orders_col.create_index("items.product_id"),
+        product_sales_col.create_index([("total_sold_qty", -1), ("product_name", 1)]),
+    )
+    # Разово заполняем full_name_lower у клиентов, созданных до появления поля
+    start_once("customers_full_name_lower", backfill_full_name_lower)
+    start_once("customers_drop_full_name_index", drop_full_name_index)
+    # Разово досчитываем продажи по заказам, созданным до появления product_sales
+    cutoff = ObjectId()
+    start_once("product_sales_backfill", lambda: backfill_product_sales(cutoff))
 
 # ---------------------------------------------------------
 # УТИЛИТЫ ПРЕОБРАЗОВАНИЯ ДОКУМЕНТОВ В СХЕМЫ ОТВЕТА
+# Документы из БД уже прошли валидацию при записи, поэтому
+# собираем модели через model_construct без повторной проверки полей
 # ---------------------------------------------------------
 
+def to_object_id(value: str, detail: str) -> ObjectId:
+    """Разбираем ObjectId через is_valid, без исключений на каждый вызов; иначе — 400."""
+    if not ObjectId.is_valid(value):
+        raise HTTPException(status_code=400, detail=detail)
+    return ObjectId(value)
+
+
+def normalize_order_date(value: Optional[datetime]) -> datetime:
+    """Дата в том виде, в каком её хранит и возвращает Mongo: naive UTC с точностью до миллисекунд."""
+    dt = value or datetime.utcnow()
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.replace(microsecond=dt.microsecond // 1000 * 1000)
+
+
 def product_to_out(doc) -> ProductOut:
-    return ProductOut(id=str(doc["_id"]), sku=doc["sku"], name=doc["name"], price=doc["price"], stock=doc["stock"])
+    return ProductOut.model_construct(id=str(doc["_id"]), sku=doc["sku"], name=doc["name"], price=doc["price"], stock=doc["stock"])
 
 
 def customer_to_out(doc) -> CustomerOut:
-    return CustomerOut(id=str(doc["_id"]), full_name=doc["full_name"], email=doc["email"])
+    return CustomerOut.model_construct(id=str(doc["_id"]), full_name=doc["full_name"], email=doc["email"])
+
+
+def orjson_default(obj):
+    """Хук orjson для типов BSON: ObjectId сериализуем строкой."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+# Проекции и сортировки для списков — константы модуля, не пересобираются на каждый запрос.
+# Mongo сразу отдаёт документ в форме ответа (_id -> id),
+# поэтому строки сериализуются orjson как есть, без промежуточных моделей
+PRODUCT_LIST_PROJECTION = {"id": "$_id", "_id": 0, "sku": 1, "name": 1, "price": 1, "stock": 1}
+CUSTOMER_LIST_PROJECTION = {"id": "$_id", "_id": 0, "full_name": 1, "email": 1}
+ORDER_LIST_PROJECTION = {"id": "$_id", "_id": 0, "date": 1, "status": 1, "customer_id": 1}
+ORDER_LIST_SORT = [("date", -1)]
+SALES_REPORT_PROJECTION = {"_id": 0, "product_name": 1, "total_sold_qty": 1}
+SALES_REPORT_SORT = [("total_sold_qty", -1), ("product_name", 1)]
+
+
+def normalize_name(full_name: str) -> str:
+    """ФИО для поиска без учёта регистра (поле full_name_lower)."""
+    return full_name.lower()
+
 
+async def backfill_full_name_lower():
+    """Заполняем full_name_lower у старых клиентов пачками, не загружая всю коллекцию в память."""
+    cursor = customers_col.find({"full_name_lower": None}, {"full_name": 1}).batch_size(STREAM_BATCH_SIZE)
+    while batch := await cursor.to_list(STREAM_BATCH_SIZE):
+        await customers_col.bulk_write([
+            UpdateOne({"_id": d["_id"]}, {"$set": {"full_name_lower": normalize_name(d["full_name"])}})
+            for d in batch
+        ], ordered=False)
+
+
+async def drop_full_name_index():
+    """Удаляем b-tree индекс full_name из старых версий: поиск идёт по text-индексу и full_name_lower."""
+    try:
+        await customers_col.drop_index("full_name_1")
+    except OperationFailure:
+        pass  # индекса нет — база создана уже без него
+
+
+@lru_cache(maxsize=256)
+def customer_name_prefix(customer_name: str) -> Regex:
+    """Поиск по началу ФИО по полю full_name_lower: якорь ^ и без флага i, чтобы работал индекс."""
+    return Regex(f"^{re.escape(normalize_name(customer_name))}")
+
+
+# Сколько клиентов максимум подставляем в $in при поиске заказов по ФИО
+CUSTOMER_SEARCH_LIMIT = 1000
+
+# Размер пачки документов, которую курсор забирает из Mongo за один раз
+STREAM_BATCH_SIZE = 500
+
+
+async def stream_json_array(cursor, first_batch: list) -> AsyncIterator[bytes]:
+    """Отдаём курсор JSON-массивом по мере чтения, не загружая выборку целиком в память.
+
+    Документы сериализуются пачками: один вызов orjson и одна отправка клиенту
+    на пачку, а не на каждый документ.
+    """
+    yield b"["
+    if first_batch:
+        yield orjson.dumps(first_batch, default=orjson_default)[1:-1]  # без внешних скобок массива
+        while batch := await cursor.to_list(STREAM_BATCH_SIZE):
+            yield b"," + orjson.dumps(batch, default=orjson_default)[1:-1]
+    yield b"]"
+
+
+async def stream_response(cursor) -> StreamingResponse:
+    # Первую пачку читаем до отправки статуса: ошибки подключения и запроса
+    # вернутся обычным 500, а не оборванным ответом 200
+    cursor.batch_size(STREAM_BATCH_SIZE)
+    first_batch = await cursor.to_list(STREAM_BATCH_SIZE)
+    return StreamingResponse(stream_json_array(cursor, first_batch), media_type="application/json")
+
+
+# Эндпоинты объявлены с response_model=None: FastAPI не прогоняет ответ повторно
+# через Pydantic, а схема для /docs задаётся через responses. Обратная сторона —
+# форма ответа не проверяется, её должны гарантировать сами обработчики.
 
 # ---------------------------------------------------------
 # ЭНДПОИНТЫ: PRODUCTS
 # ---------------------------------------------------------
-@app.get("/products", response_model=List[ProductOut], summary="Список товаров")
+@app.get("/products", response_model=None, responses={200: {"model": List[ProductOut]}}, summary="Список товаров")
 async def list_products():
-    # Возвращаем весь каталог товаров
-    docs = await products_col.find({}).to_list(None)
-    return [product_to_out(d) for d in docs]
+    # Возвращаем весь каталог товаров потоком
+    return await stream_response(products_col.find({}, PRODUCT_LIST_PROJECTION))
 
 
-@app.post("/products", response_model=ProductOut, summary="Создать товар")
+@app.post("/products", response_model=None, responses={200: {"model": ProductOut}}, summary="Создать товар")
 async def create_product(body: ProductIn):
-    # Вставляем товар, проверяем уникальность sku индексом
+    # Вставляем товар, проверяем уникальность sku индексом.
+    # insert_one дописывает _id в doc, поэтому перечитывать документ из БД не нужно
     doc = body.model_dump()
-    res = await products_col.insert_one(doc)
-    created = await products_col.find_one({"_id": res.inserted_id})
-    return product_to_out(created)
+    await products_col.insert_one(doc)
+    return product_to_out(doc)
 
 
 # ---------------------------------------------------------
 # ЭНДПОИНТЫ: CUSTOMERS
 # ---------------------------------------------------------
-@app.get("/customers", response_model=List[CustomerOut], summary="Список клиентов")
+@app.get("/customers", response_model=None, responses={200: {"model": List[CustomerOut]}}, summary="Список клиентов")
 async def list_customers():
-    docs = await customers_col.find({}).to_list(None)
-    return [customer_to_out(d) for d in docs]
+    return await stream_response(customers_col.find({}, CUSTOMER_LIST_PROJECTION))
 
 
-@app.post("/customers", response_model=CustomerOut, summary="Создать клиента")
+@app.post("/customers", response_model=None, responses={200: {"model": CustomerOut}}, summary="Создать клиента")
 async def create_customer(body: CustomerIn):
     doc = body.model_dump()
-    res = await customers_col.insert_one(doc)
-    created = await customers_col.find_one({"_id": res.inserted_id})
-    return customer_to_out(created)
+    doc["full_name_lower"] = normalize_name(doc["full_name"])
+    await customers_col.insert_one(doc)
+    return customer_to_out(doc)
 
 
 
 # ---------------------------------------------------------
 # ЭНДПОИНТЫ: ORDERS
 # ---------------------------------------------------------
-@app.get("/orders", response_model=List[OrderShortOut], summary="Список заказов с фильтрами")
+@app.get("/orders", response_model=None, responses={200: {"model": List[OrderShortOut]}}, summary="Список заказов с фильтрами")
 async def list_orders(
     status: Optional[str] = Query(None, description="Фильтр по статусу, например NEW/PAID/SHIPPED"),
     customer_id: Optional[str] = Query(None, description="Фильтр по ID клиента"),
@@ -199,123 +385,153 @@ async def list_orders(
 
     # Поиск по ID клиента — просто фильтр по полю
     if customer_id:
-        try:
-            query["customer_id"] = ObjectId(customer_id)
-        except Exception:
-            raise HTTPException(status_code=400, detail="Некорректный формат customer_id")
+        query["customer_id"] = to_object_id(customer_id, "Некорректный формат customer_id")
 
-    # Поиск по ФИО клиента (частичное совпадение, регистронезависимо)
+    # Поиск по ФИО клиента: фраза по полнотекстовому индексу, а для части слова — префиксный regex
     if customer_name:
-        # Находим всех клиентов, чьё ФИО содержит искомую подстроку
-        customer_docs = await customers_col.find({
-            "full_name": {"$regex": customer_name, "$options": "i"}
-        }, {"_id": 1}).to_list(None)
-        ids = [d["_id"] for d in customer_docs]
-        query["customer_id"] = {"$in": ids or [ObjectId()]}  # если список пуст, подставим нереальный id
-
-    # Выполняем поиск заказов с сортировкой по дате (новые сверху)
-    docs = await orders_col.find(query).sort("date", -1).to_list(None)
-    result = [
-        OrderShortOut(
-            id=str(d["_id"]),
-            date=d["date"],
-            status=d["status"],
-            customer_id=str(d["customer_id"])  # как строку
-        )
-        for d in docs
-    ]
-    return result
-
-
-@app.post("/orders", response_model=OrderShortOut, summary="Создать заказ")
+        # Фраза в кавычках: все слова должны идти подряд, а не через OR
+        phrase = '"{}"'.format(customer_name.replace('"', ""))
+        customer_docs = await customers_col.find(
+            {"$text": {"$search": phrase}}, {"_id": 1}
+        ).limit(CUSTOMER_SEARCH_LIMIT).to_list(None)
+        if not customer_docs:
+            # Текстовый поиск ищет слова целиком («Иван» не найдёт «Иванов») — пробуем по началу ФИО
+            customer_docs = await customers_col.find(
+                {"full_name_lower": customer_name_prefix(customer_name)}, {"_id": 1}
+            ).limit(CUSTOMER_SEARCH_LIMIT).to_list(None)
+        # Никто не найден — заказов заведомо нет, в Mongo не ходим
+        if not customer_docs:
+            return []
+        query["customer_id"] = {"$in": [d["_id"] for d in customer_docs]}
+
+    # Выполняем поиск заказов с сортировкой по дате (новые сверху), забираем только нужные поля
+    cursor = orders_col.find(query, ORDER_LIST_PROJECTION).sort(ORDER_LIST_SORT)
+    return await stream_response(cursor)
+
+
+@app.post("/orders", response_model=None, responses={200: {"model": OrderShortOut}}, summary="Создать заказ")
 async def create_order(body: OrderIn):
-    # Валидация существования клиента
-    try:
-        cust_id = ObjectId(body.customer_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Некорректный customer_id")
+    cust_id = to_object_id(body.customer_id, "Некорректный customer_id")
+    item_pids = [to_object_id(it.product_id, "Некорректный product_id") for it in body.items]
+    qty_by_pid = {}
+    for pid, it in zip(item_pids, body.items):
+        qty_by_pid[pid] = qty_by_pid.get(pid, 0) + it.quantity
+    pids = list(qty_by_pid)
+
+    # Клиент и товары не зависят друг от друга — читаем их параллельно
+    customer, prods = await asyncio.gather(
+        customers_col.find_one({"_id": cust_id}),
+        products_col.find({"_id": {"$in": pids}}).to_list(None),
+    )
 
-    customer = await customers_col.find_one({"_id": cust_id})
+    # Валидация существования клиента
     if not customer:
         raise HTTPException(status_code=404, detail="Клиент не найден")
 
-    # Валидация элементов: наличие товаров и достаточный stock (упрощённая логика)
-    for it in body.items:
-        try:
-            pid = ObjectId(it.product_id)
-        except Exception:
-            raise HTTPException(status_code=400, detail="Некорректный product_id")
-        prod = await products_col.find_one({"_id": pid})
+    # Валидация элементов: наличие товаров и достаточный stock
+    prod_map = {p["_id"]: p for p in prods}
+    for pid, qty in qty_by_pid.items():
+        prod = prod_map.get(pid)
         if not prod:
-            raise HTTPException(status_code=404, detail=f"Товар {it.product_id} не найден")
-        if prod["stock"] < it.quantity:
+            raise HTTPException(status_code=404, detail=f"Товар {pid} не найден")
+        if prod["stock"] < qty:
             raise HTTPException(status_code=400, detail=f"Недостаточно остатка для товара {prod['name']}")
 
-    # Списываем остатки 
-    for it in body.items:
-        await products_col.update_one({"_id": ObjectId(it.product_id)}, {"$inc": {"stock": -it.quantity}})
+    # Списываем остатки параллельно; условие $gte защищает от ухода в минус при гонке.
+    # Результат по каждому товару нужен, чтобы вернуть уже списанное, если где-то не хватило
+    results = await asyncio.gather(*[
+        products_col.update_one({"_id": pid, "stock": {"$gte": qty}}, {"$inc": {"stock": -qty}})
+        for pid, qty in qty_by_pid.items()
+    ])
+    if any(r.modified_count == 0 for r in results):
+        # Откатываем применённые списания, заказ не создаём
+        await asyncio.gather(*[
+            products_col.update_one({"_id": pid}, {"$inc": {"stock": qty}})
+            for (pid, qty), r in zip(qty_by_pid.items(), results)
+            if r.modified_count
+        ])
+        raise HTTPException(status_code=409, detail="Остатки изменились во время оформления заказа, повторите попытку")
 
     # Сохраняем заказ с нормализованными ObjectId
     doc = {
         "customer_id": cust_id,
         "status": body.status,
-        "date": body.date or datetime.utcnow(),
+        "date": normalize_order_date(body.date),
         "items": [
             {
-                "product_id": ObjectId(it.product_id),
+                "product_id": pid,
                 "quantity": it.quantity,
                 "unit_price": it.unit_price,
             }
-            for it in body.items
+            for pid, it in zip(item_pids, body.items)
         ]
     }
     res = await orders_col.insert_one(doc)
-    created = await orders_col.find_one({"_id": res.inserted_id})
-    return OrderShortOut(
-        id=str(created["_id"]),
-        date=created["date"],
-        status=created["status"],
-        customer_id=str(created["customer_id"])
+
+    # Инкрементально обновляем счётчики для отчёта «Продажи по товарам».
+    # Заказ уже сохранён: ошибку счётчиков только логируем, иначе клиент получит 500
+    # на созданный заказ и повторит его. Разошедшиеся счётчики чинит /dev/rebuild_sales_by_product
+    if qty_by_pid:
+        try:
+            await product_sales_col.bulk_write([
+                UpdateOne(
+                    {"_id": pid},
+                    {"$inc": {"total_sold_qty": qty}, "$setOnInsert": {"product_name": prod_map[pid]["name"]}},
+                    upsert=True,
+                )
+                for pid, qty in qty_by_pid.items()
+            ], ordered=False)
+        except Exception:
+            logger.exception("Не удалось обновить счётчики продаж для заказа %s", res.inserted_id)
+
+    return OrderShortOut.model_construct(
+        id=str(res.inserted_id),
+        date=doc["date"],
+        status=doc["status"],
+        customer_id=str(cust_id)
     )
 
 
-@app.get("/orders/{order_id}", response_model=OrderDetailOut, summary="Детализация заказа")
+@app.get("/orders/{order_id}", response_model=None, responses={200: {"model": OrderDetailOut}}, summary="Детализация заказа")
 async def get_order_detail(order_id: str):
     # Получаем заказ по ID
-    try:
-        oid = ObjectId(order_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Некорректный order_id")
+    oid = to_object_id(order_id, "Некорректный order_id")
 
 
-    order = await orders_col.find_one({"_id": oid})
-    if not order:
+    # Заказ и клиент — одним aggregate с $lookup; товары берём из кэша get_products
+    pipeline = [
+        {"$match": {"_id": oid}},
+        {"$lookup": {
+            "from": "customers",
+            "localField": "customer_id",
+            "foreignField": "_id",
+            "as": "customer"
+        }},
+        {"$unwind": {"path": "$customer", "preserveNullAndEmptyArrays": True}},
+    ]
+    docs = await orders_col.aggregate(pipeline).to_list(1)
+    if not docs:
         raise HTTPException(status_code=404, detail="Заказ не найден")
+    order = docs[0]
 
-    # Загружаем клиента
-    customer = await customers_col.find_one({"_id": order["customer_id"]})
+    customer = order.get("customer")
     if not customer:
         raise HTTPException(status_code=500, detail="Данные клиента повреждены")
 
-    # Собираем детали по товарам заказа одним запросом (in)
-    product_ids = list({it["product_id"] for it in order["items"]})
-    prod_map = {}
-    if product_ids:
-        products = await products_col.find({"_id": {"$in": product_ids}}).to_list(None)
-        prod_map = {p["_id"]: p for p in products}
+    prod_map = await get_products({it["product_id"] for it in order["items"]})
 
     # Формируем список детализированных позиций
     detailed_items = []
     for it in order["items"]:
         prod = prod_map.get(it["product_id"]) or {}
-        detailed_items.append(OrderItemDetailed(
+        detailed_items.append(OrderItemDetailed.model_construct(
             sku=prod.get("sku", "—"),
             product_name=prod.get("name", "Товар удалён"),
             unit_price=float(it["unit_price"]),
             quantity=int(it["quantity"])
         ))
 
-    return OrderDetailOut(
+    return OrderDetailOut.model_construct(
         id=str(order["_id"]),
         date=order["date"],
         status=order["status"],
@@ -327,10 +543,11 @@ async def get_order_detail(order_id: str):
 # ---------------------------------------------------------
 # ОТЧЁТ: ПРОДАЖИ ПО ТОВАРАМ
 # ---------------------------------------------------------
-@app.get("/reports/sales_by_product", response_model=List[SalesByProductRow], summary="Сводный отчёт: продажи по товарам")
-async def report_sales_by_product():
-    """Агрегируем общее количество проданных единиц по каждому товару."""
-    pipeline = [
+def sales_by_product_stages() -> list:
+    """Стадии агрегации, считающие продажи по товарам в формате product_sales."""
+    return [
+        # Оставляем только нужные поля позиций, чтобы не тащить по конвейеру весь заказ
+        {"$project": {"_id": 0, "items.product_id": 1, "items.quantity": 1}},
         {"$unwind": "$items"},
         {"$group": {
             "_id": "$items.product_id",
@@ -347,11 +564,41 @@ async def report_sales_by_product():
             "product_name": {"$ifNull": ["$prod.name", "Товар удалён"]},
             "total_sold_qty": 1
         }},
-        {"$sort": {"total_sold_qty": -1, "product_name": 1}}
     ]
 
-    rows = await orders_col.aggregate(pipeline).to_list(None)
-    return [SalesByProductRow(product_name=r["product_name"], total_sold_qty=int(r["total_sold_qty"])) for r in rows]
+
+async def rebuild_product_sales():
+    """Пересчитываем коллекцию product_sales агрегацией по всем заказам.
+
+    $out собирает результат во временной коллекции и атомарно подменяет ею product_sales.
+    Безопасно только пока заказы не создаются: продажа, засчитанная create_order между
+    чтением заказов и подменой, потеряется. Запускайте при остановленном приёме заказов.
+    """
+    pipeline = sales_by_product_stages() + [{"$out": product_sales_col.name}]
+    await orders_col.aggregate(pipeline).to_list(None)
+
+
+async def backfill_product_sales(cutoff: ObjectId):
+    """Досчитываем в product_sales заказы, созданные раньше cutoff.
+
+    Результат прибавляется к текущим счётчикам через $merge, поэтому параллельные
+    инкременты из create_order не затираются и приём заказов останавливать не нужно.
+    """
+    pipeline = [{"$match": {"_id": {"$lt": cutoff}}}] + sales_by_product_stages() + [
+        {"$merge": {
+            "into": product_sales_col.name,
+            "whenMatched": [{"$set": {"total_sold_qty": {"$add": ["$total_sold_qty", "$$new.total_sold_qty"]}}}],
+            "whenNotMatched": "insert",
+        }}
+    ]
+    await orders_col.aggregate(pipeline).to_list(None)
+
+
+@app.get("/reports/sales_by_product", response_model=None, responses={200: {"model": List[SalesByProductRow]}}, summary="Сводный отчёт: продажи по товарам")
+async def report_sales_by_product():
+    """Читаем готовые счётчики продаж, которые обновляет create_order."""
+    cursor = product_sales_col.find({}, SALES_REPORT_PROJECTION).sort(SALES_REPORT_SORT)
+    return await stream_response(cursor)
 
 
 # ---------------------------------------------------------
@@ -359,10 +606,13 @@ async def report_sales_by_product():
 # ---------------------------------------------------------
 @app.post("/dev/seed", summary="Засеять БД тестовыми данными")
 async def dev_seed():
-    # Очищаем коллекции
-    await products_col.delete_many({})
-    await customers_col.delete_many({})
-    await orders_col.delete_many({})
+    # Очищаем коллекции параллельно
+    await asyncio.gather(
+        products_col.delete_many({}),
+        customers_col.delete_many({}),
+        orders_col.delete_many({}),
+    )
+    product_cache.clear()
 
     # Добавим товары
     prods = [
@@ -370,14 +620,20 @@ async def dev_seed():
         {"sku": "SKU-002", "name": "Футболка", "price": 19.9, "stock": 50},
         {"sku": "SKU-003", "name": "Рюкзак", "price": 49.0, "stock": 30},
     ]
-    pres = await products_col.insert_many(prods)
 
     # Клиенты
     custs = [
         {"full_name": "Иван Петров", "email": "ivan@example.com"},
         {"full_name": "Мария Сидорова", "email": "maria@example.com"},
     ]
-    cres = await customers_col.insert_many(custs)
+    for c in custs:
+        c["full_name_lower"] = normalize_name(c["full_name"])
+
+    # Товары и клиенты независимы — вставляем одновременно
+    pres, cres = await asyncio.gather(
+        products_col.insert_many(prods, ordered=False),
+        customers_col.insert_many(custs, ordered=False),
+    )
 
     # Пара заказов
     orders = [
@@ -400,7 +656,35 @@ async def dev_seed():
         },
     ]
     await orders_col.insert_many(orders)
+    # Заказы вставлены напрямую, минуя create_order — пересчитываем счётчики
+    await rebuild_product_sales()
+
+    return {"ok": True}
 
 
+@app.post("/dev/rebuild_sales_by_product", summary="Пересчитать отчёт «Продажи по товарам» в фоне",
+          description="Безопасно только при остановленном приёме заказов: иначе счётчики могут разойтись.")
+async def dev_rebuild_sales_by_product(background_tasks: BackgroundTasks):
+    # Агрегация по всем заказам выполняется после отправки ответа, не задерживая запрос.
+    # Вызывать только когда заказы не создаются — см. rebuild_product_sales
+    background_tasks.add_task(rebuild_product_sales)
     return {"ok": True}
 
+
+# ---------------------------------------------------------
+# ЛОКАЛЬНЫЙ ЗАПУСК: python main.py
+# ---------------------------------------------------------
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop + httptools заметно снижают накладные расходы сервера на каждый await.
+    # Пул потоков motor задаётся через MOTOR_MAX_WORKERS; держите его небольшим —
+    # лишние потоки только конкурируют за GIL
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )